@@ -20,33 +20,155 @@ Options:
   --output=<file>   Save trimmed backup to separate file
 '''
 import os
+import io
+import copy
 import sys
+import shutil
+import hashlib
+import mmap
 import tarfile
 import fnmatch
+import re
 import json
 import logging
 import time
-import tempfile
 import zipfile
+import zlib
+from array import array
+import queue
+import threading
+import sqlite3
 from tqdm import tqdm
-from collections import OrderedDict
+from collections import deque, namedtuple
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from docopt import docopt
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger('backup')
 
+CACHE_VERSION = 2       # Schema version of the files cache
+
+COMPRESSLEVEL = 3       # zlib level for data zips, much faster than the default of 6
+COMPRESS_MAX = 16*1024*1024     # Larger files are compressed by zipfile on the main thread
+INFLIGHT_MAX = 256*1024*1024    # Total size of files being compressed at once
+STORED_EXTS = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.avi', 
+    '.zip', '.gz', '.bz2', '.xz', '.7z', '.rar'}   # Already compressed, stored as-is
+
+CacheEntry = namedtuple('CacheEntry', 'name size mtime location hash')
+
+def _dumps(obj):
+    """Serialises obj to sorted, indented JSON bytes, using orjson if available"""
+    if orjson: return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2)
+    return json.dumps(obj, sort_keys=True, indent=2).encode()
+
+def _loads(data):
+    """Parses JSON bytes, using orjson if available"""
+    if orjson: return orjson.loads(data)
+    return json.loads(data.decode())
+
 def taraddstr(tarobj, arcname, string):
-    """Saves a string as a file in specified tar archive"""
-    with tempfile.TemporaryFile() as temp:
-        temp.write(string.encode())
-        temp.seek(0)
-        tinfo = tarobj.gettarinfo(arcname=arcname, fileobj=temp)
-        tarobj.addfile(tinfo, temp)
-
-def _copyfileobj(src, dst, length=None, exception=OSError):
+    """Saves a string (or bytes) as a file in specified tar archive"""
+    data = string.encode() if isinstance(string, str) else string
+    tinfo = tarfile.TarInfo(arcname)
+    tinfo.size = len(data)
+    tinfo.mtime = int(time.time())
+    tinfo.mode = 0o644
+    tarobj.addfile(tinfo, io.BytesIO(data))
+
+class _TarAppender(io.RawIOBase):
+    """Writable file object that streams a new member of unknown size into a tar
+       archive opened for writing. A header is reserved up front and filled in 
+       once the size is known. Positions are relative to the start of the member.
+    """
+    def __init__(self, tarobj, arcname):
+        self.tarobj = tarobj
+        self.fp = tarobj.fileobj
+        self.tinfo = tarfile.TarInfo(arcname)
+        self.tinfo.mtime = int(time.time())
+        self.tinfo.mode = 0o644
+        self.tinfo.offset = tarobj.offset
+        self.fp.seek(self.tinfo.offset)
+        self.fp.truncate()                      # Drop old end of archive padding
+        self.fp.write(self._header())           # Placeholder, rewritten on close
+        self.start = self.tinfo.offset_data = self.fp.tell()
+
+    def _header(self):
+        # GNU headers stay one block long for any size, so the placeholder can be
+        # overwritten in place (PAX would add extended blocks for files over 8GB)
+        buf = self.tinfo.tobuf(tarfile.GNU_FORMAT, self.tarobj.encoding, self.tarobj.errors)
+        assert len(buf) == tarfile.BLOCKSIZE
+        return buf
+
+    def writable(self): return True
+    def seekable(self): return True
+    def write(self, b): return self.fp.write(b)
+    def tell(self): return self.fp.tell() - self.start
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET: pos += self.start
+        return self.fp.seek(pos, whence) - self.start
+
+    def close(self):
+        if self.closed: return
+        super().close()
+        end = self.fp.seek(0, io.SEEK_END)
+        self.tinfo.size = end - self.start
+        blocks, remainder = divmod(self.tinfo.size, tarfile.BLOCKSIZE)
+        if remainder: self.fp.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        end = self.fp.tell()
+        self.fp.seek(self.tinfo.offset)
+        self.fp.write(self._header())
+        self.fp.seek(end)
+        self.tarobj.offset = end
+        self.tarobj.members.append(self.tinfo)
+
+    def discard(self):
+        """Removes the partially written member from the archive"""
+        super().close()
+        self.fp.seek(self.tinfo.offset)
+        self.fp.truncate()
+        self.fp.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))   # End of archive marker
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type: self.discard()
+        else: self.close()
+
+def _compress(path, compress_type):
+    """Reads a file and compresses it for a zip entry, returning 
+       (size, CRC, hash, data) of the bytes read
+    """
+    with open(path, 'rb') as f: data = f.read()
+    size = len(data)
+    crc = zlib.crc32(data)
+    digest = hashlib.blake2b(data, digest_size=32).hexdigest()
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(COMPRESSLEVEL, zlib.DEFLATED, -15)    # Raw deflate
+        data = compressor.compress(data) + compressor.flush()
+    return size, crc, digest, data
+
+def _zipwrite(z, zinfo, size, crc, data):
+    """Writes an entry that has already been compressed to zip file z"""
+    zinfo.file_size = size          # Size of the data read, in case the file has changed
+    zinfo.CRC = crc
+    zinfo.compress_size = len(data)
+    z._writecheck(zinfo)
+    z._didModify = True
+    z.fp.seek(z.start_dir)
+    zinfo.header_offset = z.fp.tell()
+    z.fp.write(zinfo.FileHeader())
+    z.fp.write(data)
+    z.filelist.append(zinfo)
+    z.NameToInfo[zinfo.filename] = zinfo
+    z.start_dir = z.fp.tell()
+
+def _copyfileobj(src, dst, length=None, exception=OSError, bufsize=None):
     """Copy length bytes from fileobj src to fileobj dst.
        If length is None, copy the entire content.
     """
-    bufsize = 4*1024*1024
+    bufsize = bufsize or 4*1024*1024
 
     if length == 0:
         return
@@ -70,6 +192,234 @@ def _copyfileobj(src, dst, length=None, exception=OSError):
 
 tarfile.copyfileobj = _copyfileobj      # Increased copy buffer size
 
+class _MappedFile(io.RawIOBase):
+    """Read-only file object over a slice of a memory map, e.g. a tar member"""
+    def __init__(self, mm, offset, size):
+        self.view = memoryview(mm)[offset:offset+size]
+        self.pos = 0
+
+    def readable(self): return True
+    def seekable(self): return True
+    def tell(self): return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR: pos += self.pos
+        elif whence == io.SEEK_END: pos += len(self.view)
+        self.pos = max(pos, 0)
+        return self.pos
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else self.pos + size
+        data = self.view[self.pos:end].tobytes()
+        self.pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.view[self.pos:self.pos+len(b)]
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def close(self):
+        self.view.release()     # Memory map can't be closed while views exist
+        super().close()
+
+_USE_SENDFILE = hasattr(os, 'sendfile') and sys.platform.startswith('linux')   # As in shutil
+
+def _tarsendfile(tarobj, tinfo, src, offset):
+    """Adds member tinfo to tarobj, with data read from offset in file src. 
+       Data is copied in the kernel with sendfile(2) on Linux, where it can
+       write to regular files.
+    """
+    if not _USE_SENDFILE:
+        src.seek(offset)
+        tarobj.addfile(tinfo, src)
+        return
+
+    tinfo = copy.copy(tinfo)
+    fp = tarobj.fileobj
+    buf = tinfo.tobuf(tarobj.format, tarobj.encoding, tarobj.errors)
+    fp.write(buf)
+    fp.flush()              # Write header before copying behind the buffer's back
+    tinfo.offset = tarobj.offset
+    tinfo.offset_data = tarobj.offset + len(buf)
+
+    sent = 0
+    try:
+        while sent < tinfo.size:
+            count = os.sendfile(fp.fileno(), src.fileno(), offset + sent, 
+                min(tinfo.size - sent, 2**30))
+            if count == 0: raise OSError("unexpected end of data")
+            sent += count
+    except OSError:
+        if sent: raise
+        sent = -1               # sendfile unsupported here, copy in Python below
+    fp.seek(0, io.SEEK_END)     # Resync buffered file position
+    if sent < 0:
+        src.seek(offset)
+        _copyfileobj(src, fp, tinfo.size)
+
+    blocks, remainder = divmod(tinfo.size, tarfile.BLOCKSIZE)
+    if remainder: 
+        fp.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    tarobj.offset = tinfo.offset_data + blocks * tarfile.BLOCKSIZE
+    tarobj.members.append(tinfo)
+
+def _hash(path, size):
+    """Returns the hex digest of a file's contents. Files over 16KB are
+       hashed straight from a memory map, avoiding buffer copies.
+    """
+    h = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as f:
+        if size < 16384: h.update(f.read())
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm: h.update(mm)
+    return h.hexdigest()
+
+def _setlevel(zinfo, level):
+    """Sets the compression level ZipFile.open(zinfo, 'w') writes with"""
+    if hasattr(zinfo, 'compress_level'): zinfo.compress_level = level    # Python 3.13+
+    else: zinfo._compresslevel = level
+
+def _zipwritefile(z, f, compression=None):
+    """Writes the contents of BackupFile f to zip z under its blob name,
+       raising OSError if the bytes written no longer match its hash
+    """
+    zinfo = zipfile.ZipInfo.from_file(f.path, f.arcname)
+    zinfo.compress_type = z.compression if compression is None else compression
+    _setlevel(zinfo, z.compresslevel)
+    h = hashlib.blake2b(digest_size=32)
+    with open(f.path, 'rb') as src, z.open(zinfo, 'w') as out:
+        for block in iter(lambda: src.read(1024*1024), b''): 
+            h.update(block)
+            out.write(block)
+    if h.hexdigest() != f.hash: raise OSError("'{}' changed during backup".format(f.path))
+
+def _extractpath(dst, name):
+    """Path to extract archive name to under dst, with drive, absolute and 
+       '..' components removed as in ZipFile.extract
+    """
+    name = name.replace('/', os.path.sep)
+    if os.path.altsep: name = name.replace(os.path.altsep, os.path.sep)
+    name = os.path.splitdrive(name)[1]
+    invalid = ('', os.path.curdir, os.path.pardir)
+    parts = [p for p in name.split(os.path.sep) if p not in invalid]
+    if not parts: raise ValueError('Invalid file name in backup: {!r}'.format(name))
+    return os.path.join(dst, *parts)
+
+def _verheader(data):
+    """Reads the top-level scalar fields (id, time, size...) of an indented version 
+       info JSON without parsing its file list. Returns None if they can't be found.
+    """
+    m = re.match(rb'{\s*?\n( +)"', data)      # Indentation of top-level keys
+    if not m: return None
+    fields = re.finditer(rb'^' + m.group(1) + rb'"(\w+)": ([^{\[\n]*?),?$', data, re.M)
+    header = {k.decode(): _loads(v) for k, v in (f.groups() for f in fields)}
+    if not {'id', 'time', 'size', 'sizedelta'} <= set(header): return None
+    return header
+
+def _compile(patterns):
+    """Compiles a list of glob patterns into a single regex, or None if empty"""
+    if not patterns: return None
+    return re.compile('|'.join(fnmatch.translate(os.path.normcase(p)) for p in patterns))
+
+class PathFilter:
+    """Include/exclude glob patterns, compiled for matching relative paths"""
+    def __init__(self, include=None, exclude=None):
+        self.include = include
+        self.include_re = _compile(include)
+        self.include_prefixes = set()       # Every leading substring of include paths
+        self.exclude_re = _compile(exclude)
+        if include:
+            # Directories that can contain included files
+            self.include_dir_re = _compile([os.path.join(os.path.dirname(i), '*') for i in include])
+            self.include_any = any(not os.sep in i for i in include)
+            self.include_prefixes = {i[:n] for i in include for n in range(1, len(i)+1)}
+
+    def descend(self, drel):
+        """Whether the directory drel should be scanned"""
+        if self.include and not (self.include_any or drel in self.include_prefixes
+                or self.include_dir_re.match(os.path.normcase(drel))):
+            return False
+        return not (self.exclude_re and self.exclude_re.match(os.path.normcase(drel)))
+
+    def match(self, frel):
+        """Whether the file frel should be backed up"""
+        frel = os.path.normcase(frel)
+        if self.include_re and not self.include_re.match(frel): return False
+        return not (self.exclude_re and self.exclude_re.match(frel))
+
+def _scandir(src, rel, pathfilter):
+    """Scans a single directory of src, returning (subdirectories, files) as
+       lists of relative paths and (relative path, DirEntry) pairs respectively.
+    """
+    dirs, files = [], []
+    try:
+        it = os.scandir(os.path.join(src, rel))
+    except OSError:
+        return dirs, files              # Unreadable directory, skip like os.walk
+    with it:
+        for entry in it:
+            erel = os.path.join(rel, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                # Remove unnecessary directories if includes/excludes are specified
+                if pathfilter.descend(erel): dirs.append(erel)
+            elif entry.is_file() and pathfilter.match(erel):
+                entry.stat()            # Cache stat result on the DirEntry
+                files.append((erel, entry))
+    return dirs, files
+
+def _scan(src, pathfilter):
+    """Yields (relative path, DirEntry) for each file in src matching include/exclude.
+       Excluded directories are pruned before they are scanned.
+    """
+    stack = ['']
+    while stack:
+        dirs, files = _scandir(src, stack.pop(), pathfilter)
+        yield from files
+        stack.extend(reversed(dirs))    # Visit subdirectories in listing order
+
+def _parallel_scan(src, pathfilter, threads=32):
+    """Same as _scan, but directories are scanned by a pool of worker threads
+       so that many readdir/stat calls are in flight at once.
+    """
+    pending = deque([''])               # Directories waiting to be scanned (LIFO)
+    busy = 0                            # Directories currently being scanned
+    cond = threading.Condition()
+    results = queue.Queue()
+
+    def worker():
+        nonlocal busy
+        try:
+            while True:
+                with cond:
+                    while not pending and busy:
+                        cond.wait()
+                    if not pending: return      # Nothing queued or in progress
+                    rel = pending.pop()
+                    busy += 1
+                dirs = []
+                try:
+                    dirs, files = _scandir(src, rel, pathfilter)
+                    if files: results.put(files)
+                finally:
+                    with cond:
+                        pending.extend(reversed(dirs))
+                        busy -= 1
+                        cond.notify_all()
+        finally:
+            results.put(None)           # Signal that this worker has finished
+
+    with ThreadPoolExecutor(threads) as pool:
+        futures = [pool.submit(worker) for _ in range(threads)]
+        running = threads
+        while running:
+            files = results.get()
+            if files is None: running -= 1
+            else: yield from files
+    for f in futures: f.result()        # Raise any exception from the workers
+
 class BackupVersion():
     def __init__(self, id = None, time = 0, size = 0, sizedelta = 0):
         self.id = id
@@ -77,7 +427,9 @@ class BackupVersion():
         self.time = time                # Build time (in Unix time)
         self.size = size
         self.sizedelta = sizedelta      # Difference between version and last version
-        self.files = {}                 # Keys are file names, values are BackupFile objects
+        self._files = FileTable()       # Files in version, by name
+        self._files_raw = None          # Version info JSON, parsed on first access to files
+        self._nfiles = None             # Number of files, if known without parsing
         self.info = ''                  # Archive name of version info JSON
         self.data = ''                  # Archive name of version data ZIP
         self.newfiles = 0               # Number of files changed since last version
@@ -87,26 +439,107 @@ class BackupVersion():
                     'time': self.time,
                     'size': self.size,
                     'sizedelta': self.sizedelta,
-                    'files': {} }
-
-        for f in self.files.values(): 
-            verinfo['files'][f.name] = { 'mod': f.mod, 'size': f.size,
-                'location': f.location }
+                    'nfiles': len(self.files),
+                    'files': self.files.build_info() }
 
         return verinfo
 
+    @property
+    def files(self):
+        if self._files_raw is not None:
+            self._files = FileTable.from_info(_loads(self._files_raw)['files'])
+            self._files_raw = None
+        return self._files
+
+    @files.setter
+    def files(self, files):
+        self._files = files
+        self._files_raw = None
+
+    @property
+    def nfiles(self):
+        if self._nfiles is not None and self._files_raw is not None: return self._nfiles
+        return len(self.files)
+
     def set_id(self, id):
         self.id = id
         self.info = 'versions/{}/version.json'.format(self.id)
         self.data = 'versions/{}/data.zip'.format(self.id)
         
 class BackupFile:
-    def __init__(self, name = '', size = 0, mod = 0, location = None, path = None):
+    def __init__(self, name = '', size = 0, mod = 0, location = None, path = None, hash = None):
         self.name = name            # Name of file in archive
         self.size = size
         self.mod = mod              # Modification time
         self.location = location    # Version the file is located in
         self.path = path            # Path to file (backup build only)
+        self.hash = hash            # Hash of file contents (None in older backups)
+
+    @property
+    def arcname(self):
+        """Name of file contents in version data zip"""
+        if not self.hash: return self.name
+        return 'blobs/{}/{}'.format(self.hash[:2], self.hash)
+
+class FileTable:
+    """File list of a version, stored as parallel arrays instead of BackupFile 
+       objects to save memory on large versions. Rows are looked up by name.
+    """
+    def __init__(self):
+        self.names = []
+        self.sizes = array('q')
+        self.mods = array('d')          # Modification times
+        self.locations = []             # Versions the files are located in
+        self.hashes = []
+        self.paths = []                 # Paths to files (backup build only)
+        self.index = {}                 # Keys are file names, values row numbers
+
+    @classmethod
+    def from_info(cls, files):
+        """Creates a table from the 'files' dict of a version info JSON"""
+        table = cls()
+        rows = files.values()
+        table.names = list(files)
+        table.sizes = array('q', [d['size'] for d in rows])
+        table.mods = array('d', [d['mod'] for d in rows])
+        table.locations = [d['location'] for d in rows]
+        table.hashes = [d.get('hash') for d in rows]
+        table.paths = [None] * len(table.names)
+        table.index = {name: idx for idx, name in enumerate(table.names)}
+        return table
+
+    def build_info(self):
+        files = {}
+        for name, size, mod, location, hash in zip(self.names, self.sizes, self.mods,
+                self.locations, self.hashes):
+            files[name] = { 'mod': mod, 'size': size, 'location': location }
+            if hash: files[name]['hash'] = hash
+        return files
+
+    def append(self, name, size, mod, location, path = None, hash = None):
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        self.sizes.append(size)
+        self.mods.append(mod)
+        self.locations.append(location)
+        self.hashes.append(hash)
+        self.paths.append(path)
+
+    def row(self, idx):
+        return BackupFile(self.names[idx], self.sizes[idx], self.mods[idx], 
+            self.locations[idx], self.paths[idx], self.hashes[idx])
+
+    def values(self):
+        return (self.row(idx) for idx in range(len(self.names)))
+
+    def __getitem__(self, name):
+        return self.row(self.index[name])
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.names)
 
 class Backup:
     def __init__(self, file='', id = None):
@@ -115,44 +548,90 @@ class Backup:
         self.include = None
         self.exclude = None
         self.versions = {}                          # Keys are version IDs, values BackupVersion objects 
+        self._blobs = None                          # Keys are file hashes, values version IDs
         self.file = os.path.normpath(file)
         self.filename = os.path.basename(file)
         self.curver = BackupVersion()               # Current (working) version
         self.lastver = BackupVersion()              # Most recent version in archive
+        self.cachefile = '{}.cache.sqlite'.format(self.file)
+        self._fcache = None                         # Keys are file paths, values CacheEntry tuples
+                                                    # (loaded by build)
+        self._fseen = []                            # Cache rows for files in current version
+        self._has_info_json = False                 # Whether archive contains info.json
 
         if os.path.isfile(file): self.load()
 
+    @property
+    def blobs(self):
+        """File hashes stored in the archive. Parses the file list of every version."""
+        if self._blobs is None:
+            self._blobs = {}
+            for version in self.versions.values():
+                for hash, location in zip(version.files.hashes, version.files.locations):
+                    if hash: self._blobs[hash] = location
+        return self._blobs
+
     def load(self):
         with tarfile.open(self.file) as t:
-            verpaths = fnmatch.filter(t.getnames(),"versions/*/version.json")
-
-            for path in verpaths:
+            for tinfo in t:         # Single pass over members, data zips are skipped
+                if tinfo.name == 'info.json':
+                    info = _loads( t.extractfile(tinfo).read() )     # Get backup info
+                    self.id = info['id']
+                    self.include = info['include']
+                    self.exclude = info['exclude']
+                    self.src = info['src']
+                    self._has_info_json = True
+                    continue
+                if not (tinfo.name.startswith('versions/') and 
+                        tinfo.name.endswith('/version.json')): continue
+
+                path = tinfo.name
                 folder = os.path.split(path)[0]                 # Get version folder
-                verfile = t.extractfile(path)                   # Extract version info.json...
-                verinfo = json.loads(verfile.read().decode())   
+                verfile = t.extractfile(tinfo)                  # Extract version info.json...
+                raw = verfile.read()
+                verinfo = _verheader(raw) or _loads(raw)        # File list is parsed when needed
                 version = BackupVersion(verinfo['id'], verinfo['time'], 
                     verinfo['size'], verinfo['sizedelta'])
                 version.info = path                             # Save archive name of version info 
                 version.data = '{}/{}'.format(folder, 'data.zip')   # Save archive name of version data
-
-                for item, data in verinfo['files'].items():
-                    file = BackupFile(item, data['size'], data['mod'], data['location'])
-                    version.files[item] = file
+                if 'files' in verinfo: version.files = FileTable.from_info(verinfo['files'])
+                else: version._files_raw = raw
+                version._nfiles = verinfo.get('nfiles')
 
                 self.versions[version.id] = version
 
-            info = json.loads( t.extractfile('info.json').read().decode() )     # Get backup info
-            self.id = info['id']
-            self.include = info['include']
-            self.exclude = info['exclude']
-            self.src = info['src']
-
         timesort = sorted(self.versions.values(), key=lambda v: v.time)
         for idx, version in enumerate(timesort): version.num = idx+1
         latest = timesort[-1]      # Get most recent version
         self.lastver = latest
 
-    def build(self, src=None, include=[], exclude=[]):  
+    def load_cache(self):
+        """Loads the files cache for this backup, if there is one"""
+        self._fcache = {}
+        if not os.path.isfile(self.cachefile): return
+        with closing(sqlite3.connect(self.cachefile)) as db:
+            if db.execute('PRAGMA user_version').fetchone()[0] != CACHE_VERSION: return
+            for path, name, size, mtime, location, hash in db.execute('SELECT * FROM files'):
+                self._fcache[path] = CacheEntry(name, size, mtime, location, hash)
+
+    def save_cache(self, rows=(), removed=(), stale=()):
+        """Adds/updates (path, name, size, mtime, location, hash) rows in the files cache, 
+           and drops rows located in the removed versions or with stale paths
+        """
+        with closing(sqlite3.connect(self.cachefile)) as db:
+            with db:        # Single transaction
+                if db.execute('PRAGMA user_version').fetchone()[0] != CACHE_VERSION:
+                    db.execute('DROP TABLE IF EXISTS files')
+                    db.execute('PRAGMA user_version = {}'.format(CACHE_VERSION))
+                db.execute('CREATE TABLE IF NOT EXISTS files '
+                    '(path TEXT PRIMARY KEY, name TEXT, size INT, mtime REAL, location TEXT, '
+                    'hash TEXT)')
+                db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', rows)
+                db.executemany('DELETE FROM files WHERE location = ?', 
+                    [(v,) for v in removed])
+                db.executemany('DELETE FROM files WHERE path = ?', [(p,) for p in stale])
+
+    def build(self, src=None, include=[], exclude=[], threads=32):  
         self.curver = BackupVersion()  
         curver = self.curver        # Shorter
         curver.time = round(time.time())
@@ -167,48 +646,49 @@ class Backup:
         self.exclude = exclude
 
         lfiles = self.lastver.files  # File list from preceding backup version
+        self.load_cache()
+        fcache = self._fcache
+        newblobs = {}                # File hashes first stored in this version
+        self._fseen = []
 
-        if not src: src = self.src
-        else: self.src = os.path.realpath(src)
+        if src: self.src = os.path.realpath(src)
+        src = self.src              # Resolved once, so scanned paths are absolute
 
         logging.debug('Scanning for files in source directory ''{}'''.format(src))
         
-        for root, dirs, files in os.walk(src):
-            rel = os.path.relpath(root, src)
-            # Remove unnecessary directories if includes/excludes are specified
-            for d in reversed(dirs):
-                drel = os.path.normpath(os.path.join(rel, d))
-                if include and not ([i for i in include if i.startswith(drel) or
-                        fnmatch.fnmatch(drel, os.path.join(os.path.dirname(i), '*')) or 
-                        not os.sep in i]):
-                    dirs.remove(d)
-                if exclude and [e for e in exclude if fnmatch.fnmatch(drel, e)]: 
-                    dirs.remove(d)
-
-            for file in files:   
-                fpath = os.path.realpath(os.path.join(root, file))     # Path to file
-                frel = os.path.normpath(os.path.join(rel, file))
-                frel_arc = frel.replace('\\','/')  # Archive name - uses forward slashes
-                stat = os.stat(fpath)
-                mod = stat.st_mtime          # Modification time
-
-                if include:
-                    if not [m for m in include if fnmatch.fnmatch(frel, m)]: continue  
-                if exclude:
-                    if [m for m in exclude if fnmatch.fnmatch(frel, m)]: continue  
-                
-                if frel_arc in lfiles:
-                    existing = lfiles[frel_arc]
-                    if mod == existing.mod and stat.st_size == existing.size:  
-                        curver.files[frel_arc] = existing
-                        curver.size += stat.st_size
-                        continue                        # Skip file if same as previous version
-
-                curver.size += stat.st_size
-                curver.sizedelta += stat.st_size
-                curfile = BackupFile(frel_arc, stat.st_size, mod, curver.id, fpath)
+        pathfilter = PathFilter(include, exclude)
+        if threads > 1: scan = _parallel_scan(src, pathfilter, threads)
+        else: scan = _scan(src, pathfilter)
+
+        for frel, entry in scan:
+            fpath = entry.path          # Path to file
+            frel_arc = frel.replace('\\','/')  # Archive name - uses forward slashes
+            stat = entry.stat()
+            mod = stat.st_mtime          # Modification time
+
+            cached = fcache.get(fpath)
+            # Cached location is only valid if the file was stored under the same name
+            if (cached and cached.name == frel_arc and cached.mtime == mod and 
+                    cached.size == stat.st_size and cached.location in self.versions):
+                location, digest = cached.location, cached.hash
+            else:
+                idx = lfiles.index.get(frel_arc)    # Fall back to preceding version's file list
+                if idx is not None and mod == lfiles.mods[idx] and stat.st_size == lfiles.sizes[idx]:
+                    location, digest = lfiles.locations[idx], lfiles.hashes[idx]
+                else: location = None
+
+            curver.size += stat.st_size
+            if location:                # Same as previous version
+                curver.files.append(frel_arc, stat.st_size, mod, location, hash=digest)
+            else:
+                digest = _hash(fpath, stat.st_size)
+                location = self.blobs.get(digest) or newblobs.get(digest)
+                if not location:                # Contents not stored in any version yet
+                    location = newblobs[digest] = curver.id
+                    curver.sizedelta += stat.st_size
                 curver.newfiles += 1
-                curver.files[frel_arc] = curfile     # Add file to version file dict    
+                curver.files.append(frel_arc, stat.st_size, mod, location, fpath, digest)
+            self._fseen.append((fpath, frel_arc, stat.st_size, mod, location, digest))
 
         logging.debug('{} changed files found'.format(curver.newfiles))
 
@@ -221,29 +701,69 @@ class Backup:
         bakinfo = { 'id': self.id, 'src': self.src, 
             'include': self.include, 'exclude': self.exclude}
 
-        # Add files not in previous versions
-        savelist = [f for f in curver.files.values() if f.location == curver.id]
+        # Add file contents not in previous versions, once per hash
+        savelist = list({f.arcname: f for f in curver.files.values() 
+            if f.location == curver.id}.values())
 
-        if savelist:
+        if curver.newfiles:
             if verbose: logging.info("Backing up '{}' > '{}'".format(self.src, os.path.basename(file)))
             with tarfile.open(file, 'a') as t:           
-                with tempfile.SpooledTemporaryFile(256000000) as temp:   # Write data zip to temp file
-                    with zipfile.ZipFile(temp, 'w', compression=zipfile.ZIP_DEFLATED) as z:
-                        for f in tqdm(savelist, ncols=100): 
-                            compression = None
-                            name, ext = os.path.splitext(f.name)
-                            if ext in {'.png','.jpg','.zip'}: compression = zipfile.ZIP_STORED
-                            z.write(f.path, f.name, compression)    
-
-                    temp.seek(0)
-                    tinfo = t.gettarinfo(arcname=curver.data, fileobj=temp)
-                    t.addfile(tinfo, temp)     # Add zip created in temp to tarball
+                if savelist:
+                    with _TarAppender(t, curver.data) as data:     # Write data zip into tarball
+                        with zipfile.ZipFile(data, 'w', compression=zipfile.ZIP_DEFLATED,
+                                compresslevel=COMPRESSLEVEL) as z:
+                            self._writezip(z, savelist)
                 
-                if not 'info.json' in t.getnames(): taraddstr(t, 'info.json', json.dumps(bakinfo)) # Backup info
-                taraddstr(t, curver.info, json.dumps(verinfo,sort_keys=True,indent=4)) # Version info
+                if os.path.normpath(file) == self.file: has_info = self._has_info_json
+                else: has_info = 'info.json' in t.getnames()    # Saving to another archive
+                if not has_info: taraddstr(t, 'info.json', _dumps(bakinfo)) # Backup info
+                taraddstr(t, curver.info, _dumps(verinfo)) # Version info
                       
         else: logging.info("Skipped backup '{}' (no files to backup)".format(self.src))
 
+        if os.path.normpath(file) == self.file: 
+            if curver.newfiles: self._has_info_json = True
+            # Drop cached files under the source directory that are no longer backed up
+            seen = {row[0] for row in self._fseen}
+            root = os.path.join(self.src, '')
+            stale = [p for p in self._fcache or () if p.startswith(root) and p not in seen]
+            self.save_cache(self._fseen, stale=stale)
+
+
+    def _writezip(self, z, savelist, threads=None):
+        """Adds files to zip z, compressing them on a pool of threads (zlib
+           releases the GIL) and writing them in order on this thread
+        """
+        if not threads: threads = os.cpu_count() or 1
+        pending = deque()       # Files being compressed, bounded to limit memory use
+        inflight = 0            # Total size of pending files
+
+        def write_next():
+            nonlocal inflight
+            f, compression, future = pending.popleft()
+            if future:
+                size, crc, digest, data = future.result()
+                inflight -= f.size
+                if digest != f.hash: raise OSError("'{}' changed during backup".format(f.path))
+                zinfo = zipfile.ZipInfo.from_file(f.path, f.arcname)
+                zinfo.compress_type = compression
+                _zipwrite(z, zinfo, size, crc, data)
+            else: _zipwritefile(z, f, compression)
+            progress.update()
+
+        with tqdm(total=len(savelist), ncols=100) as progress, ThreadPoolExecutor(threads) as pool:
+            for f in savelist:
+                compression = zipfile.ZIP_DEFLATED
+                name, ext = os.path.splitext(f.name)
+                if ext.lower() in STORED_EXTS: compression = zipfile.ZIP_STORED
+                if f.size > COMPRESS_MAX: future = None
+                else: 
+                    future = pool.submit(_compress, f.path, compression)
+                    inflight += f.size
+                pending.append((f, compression, future))
+                while pending and (len(pending) > 2*threads or inflight > INFLIGHT_MAX): 
+                    write_next()
+            while pending: write_next()
 
     def restore(self, dst, ver = None, to_zip = False):
         if not ver: version = self.lastver
@@ -252,27 +772,51 @@ class Backup:
             version = self.lastver      
         else: version = self.versions[ver]
         
-        extractlist = {}    # Keys: version id, Values: file names to extract from version
-        for file in version.files.values():
-            if not file.location in extractlist: extractlist[file.location] = [file.name]
-            else: extractlist[file.location].append(file.name)
+        self.restorefiles(version.files.values(), dst, to_zip)
+
+        logging.info("Restored '{}' > '{}'".format(self.filename, dst))
+
+    def restorefiles(self, files, dst, to_zip = False, as_blobs = False):
+        """Extracts BackupFile objects to directory dst, or to zip file dst if to_zip.
+           With as_blobs, zip entries keep their data zip names and are written 
+           once per blob (for trimming), instead of once per file name.
+        """
+        extractlist = {}    # Keys: version id, Values: files to extract from version
+        for file in files:
+            if not file.location in extractlist: extractlist[file.location] = [file]
+            else: extractlist[file.location].append(file)
         
-        if to_zip: zfileobj = zipfile.ZipFile(dst, 'w', compression=zipfile.ZIP_DEFLATED)
-        with tarfile.open(self.file) as t:
+        if to_zip: 
+            zfileobj = zipfile.ZipFile(dst, 'w', compression=zipfile.ZIP_DEFLATED,
+                compresslevel=COMPRESSLEVEL)
+            written = set()     # Zip entries already written
+        with tarfile.open(self.file) as t, \
+                mmap.mmap(t.fileobj.fileno(), 0, access=mmap.ACCESS_READ) as mm:
             for ver, files in extractlist.items():
-                zfile = t.extractfile(self.versions[ver].data)      # Open version data zip
-                with zipfile.ZipFile(zfile) as z:
+                tinfo = t.getmember(self.versions[ver].data)      # Open version data zip
+                if tinfo.size < 16384: zfile = t.extractfile(tinfo)    # Small, cheaper to read
+                else: zfile = _MappedFile(mm, tinfo.offset_data, tinfo.size)
+                with zfile, zipfile.ZipFile(zfile) as z:
                     for file in files: 
                         if to_zip: 
-                            info = z.getinfo(file)
-                            if info.file_size > 50000000:   # Extract to disk if file > 50MB
-                                with tempfile.TemporaryDirectory() as tmpdir:
-                                   z.extract(file, tmpdir)
-                                   zfileobj.write(os.path.join(tmpdir, info.filename), info.filename)
-                            else: zfileobj.writestr(info, z.read(file))
-                        else: z.extract(file, dst)
-
-        logging.info("Restored '{}' > '{}'".format(self.filename, dst))
+                            name = file.arcname if as_blobs else file.name
+                            if name in written: continue
+                            written.add(name)
+                            info = z.getinfo(file.arcname)
+                            outinfo = zipfile.ZipInfo(name, info.date_time)
+                            outinfo.compress_type = info.compress_type
+                            outinfo.external_attr = info.external_attr
+                            outinfo.file_size = info.file_size      # Lets zipfile pick zip64 up front
+                            _setlevel(outinfo, COMPRESSLEVEL)
+                            # Stream entry between zips without holding it in memory
+                            with z.open(info) as src, zfileobj.open(outinfo, 'w') as out:
+                                shutil.copyfileobj(src, out, 4*1024*1024)
+                        else:
+                            path = _extractpath(dst, file.name)
+                            os.makedirs(os.path.dirname(path), exist_ok=True)
+                            with z.open(file.arcname) as src, open(path, 'wb') as out:
+                                shutil.copyfileobj(src, out, 4*1024*1024)
+        if to_zip: zfileobj.close()
 
     
     def trim(self, ver = None, file = None):
@@ -282,42 +826,49 @@ class Backup:
         if not file: file = self.file
         working = '{}.tempfile'.format(file)        # Temporary file in case something goes wrong
 
+        # Retrieve all newer versions from current backup
+        remaining = [ v for v in self.versions.values() if v.time > version.time ]
+        removed = {v.id for v in self.versions.values() if v.time < version.time}
+        # Newer versions' files stored in the versions being removed, or in the specified
+        # version itself (not necessarily in its file list)
+        kept = removed | {version.id}
+        carried = list(version.files.values()) + [ f for v in remaining 
+            for f in v.files.values() if f.location in kept ]
+
         with tarfile.open(working, 'w') as newtar:
-            with tempfile.SpooledTemporaryFile(256000000) as temp:
-                # Use restore function to create new data.zip for version
-                self.restore(temp, version.id, to_zip=True)
-                temp.seek(0)
-                tinfo = newtar.gettarinfo(arcname=version.data, fileobj=temp)
-                newtar.addfile(tinfo, temp)
+            with _TarAppender(newtar, version.data) as data:
+                # Create new data.zip for version, including files carried over from removed versions
+                self.restorefiles(carried, data, to_zip=True, as_blobs=True)
 
             verinfo = version.build_info()              # Convert version info to JSON
             verinfo['sizedelta'] = version.size         # Removing all versions older than specified
                                                         # version, so delta size == size
-            for f in version.files.values(): 
-                verinfo['files'][f.name] = { 'mod': f.mod, 'size': f.size,
-                    'location': version.id }          # Change location to refer to specified version
+            for f in verinfo['files'].values(): 
+                f['location'] = version.id              # Change location to refer to specified version
 
-            taraddstr(newtar, version.info, json.dumps(verinfo,sort_keys=True,indent=4)) # Info JSON
+            taraddstr(newtar, version.info, _dumps(verinfo)) # Info JSON
  
+            # Archive names of newer versions' members
+            members = {name: v for v in remaining for name in (v.info, v.data)}
             with tarfile.open(self.file) as curtar:
-                # Retrieve all newer versions from current backup
-                remaining = [ v for v in self.versions.values() if v.time > version.time ]
-                bakinfo = curtar.getmember('info.json')
-                newtar.addfile(bakinfo, curtar.extractfile(bakinfo))
-
-                for v in sorted(remaining, key=lambda v: v.time):
-                    data = curtar.getmember(v.data)
-                    newtar.addfile(data, curtar.extractfile(data))
-                    verinfo = v.build_info()
-                    # If file is located in version older than specified, change location
-                    for f in verinfo['files'].values():  
-                        if self.versions[f['location']].time < version.time: 
-                            f['location'] = version.id  
-                    taraddstr(newtar, v.info, json.dumps(verinfo,sort_keys=True,indent=4))
+                for tinfo in curtar:    # Copy members in archive order, without seeking back
+                    v = members.get(tinfo.name)
+                    if tinfo.name == 'info.json' or (v and tinfo.name == v.data):
+                        _tarsendfile(newtar, tinfo, curtar.fileobj, tinfo.offset_data)
+                    elif v:
+                        verinfo = v.build_info()
+                        # If file is located in version older than specified, change location
+                        for f in verinfo['files'].values():  
+                            if f['location'] in removed: 
+                                f['location'] = version.id  
+                        taraddstr(newtar, v.info, _dumps(verinfo))
 
         if os.path.isfile(file): os.remove(file)  
         os.rename(working, file)
 
+        if os.path.normpath(file) == self.file:     # Drop cached files from removed versions
+            self.save_cache(removed=removed)
+
         logging.info("Trimmed backup '{}' to version {}".format(
                 self.filename, version.id))
 
@@ -355,27 +906,15 @@ def main():
 
     if args['info']:
         print('Source:', bak.src, '\n')
-        table = OrderedDict([('No.', []), ('Time', []), ('Files', []), ('Size', [])])
-        width = {}
-        space = 2
-        for vid, version in sorted(bak.versions.items()):        
-            table['No.'].append(str(version.num))
-            date = time.localtime(version.time)
-            table['Time'].append(time.strftime('%Y/%m/%d %H:%M:%S', date))
-            table['Files'].append(str(len(version.files)))
-            table['Size'].append(str(round(version.size/1000)))
-        for column, data in table.items():
-            colwidth = max([len(entry) for entry in data])
-            if colwidth < len(column): colwidth = len(column)
-            width[column] = colwidth
-        print( (' '*space).join([h+' '*(width[h]-len(h)) for h in table]) )
-        print( (' '*space).join(['-'*width[h] for h in table]) )
-        htext = list(table)
-        for row in zip(*table.values()):
-            rowtext = ''
-            for idx, item in enumerate(row):
-                rowtext += '{}{}'.format(item, ' '*(width[htext[idx]]-len(item)+space))
-            print(rowtext)       
+        headers = ('No.', 'Time', 'Files', 'Size')
+        rows = [ (str(v.num), time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(v.time)),
+            str(v.nfiles), str(round(v.size/1000))) 
+            for v in sorted(bak.versions.values(), key=lambda v: v.num) ]
+        widths = [ max([len(h)] + [len(r[idx]) for r in rows]) for idx, h in enumerate(headers) ]
+        fmt = (' '*2).join('{{:<{}}}'.format(w) for w in widths)
+        lines = [fmt.format(*headers), (' '*2).join('-'*w for w in widths)]
+        lines.extend(fmt.format(*row) for row in rows)
+        print('\n'.join(lines))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file